@@ -3,235 +3,391 @@
 """
 中转/ip.py
 从 https://zip.cm.edu.kg/all.txt 拉取数据，筛选包含 #SG/#HK/#JP/#TW/#KR 的行并去重，
-并发检测 IP 可达性（先 ping，ping 失败则尝试 TCP 80/443），按每国上限保存结果。
+并发检测 IP 可达性（默认直接 TCP 80/443，可选先批量 ping 预筛），按每国上限保存结果。
 输出文件：与脚本同目录下的 中转ip.txt（脚本不会自动创建目录）。
 """
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
 import re
+import select
+import struct
 import sys
-import subprocess
-import platform
 import socket
+import time
 from pathlib import Path
-from typing import Optional, Dict, List, Tuple
+from typing import Iterable, Iterator, Optional, Dict, List, Tuple
 
 URL = "https://zip.cm.edu.kg/all.txt"
 BASE_DIR = Path(__file__).parent  # 脚本所在目录（应该是 中转/）
 OUT_FILE = BASE_DIR / "cm亚太ip.txt"
 
+# 请求头（不再带 Connection: close，让 urllib3 复用连接池）
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; GithubAction/1.0)",
+    "Accept": "*/*",
+}
+
+# 模块级 Session：复用 TCP+TLS 连接，重试/多次拉取时省掉握手开销
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    SESSION = requests.Session()
+    SESSION.headers.update(HEADERS)
+    SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+except ImportError:
+    SESSION = None
+
 # 要支持的国家标签（小写）
 COUNTRIES = ["sg", "hk", "jp", "tw", "kr"]
 
 # 每个国家最多保存多少条（你指定的）
 MAX_PER_COUNTRY: Dict[str, int] = {"sg": 30, "hk": 20, "jp": 20, "tw": 10, "kr": 10}
 
-# 正则匹配标签与 IPv4（支持可选的 /n 后缀）
-PAT_TAG = re.compile(r'#(?:sg|hk|jp|tw|kr)\b', re.IGNORECASE)
-RE_IPV4 = re.compile(r'(\d{1,3}(?:\.\d{1,3}){3})(?:/\d{1,2})?')
+# 热路径用的派生常量：按 COUNTRIES 顺序的上限数组与 tag->下标映射
+CAPS: List[int] = [MAX_PER_COUNTRY.get(c, 0) for c in COUNTRIES]
+TAG_IDX: Dict[str, int] = {c: i for i, c in enumerate(COUNTRIES)}
+
+# 候选行用一条字节级正则整块匹配，命名组一次取出整行、国家标签和 IPv4
+# （支持可选的 /n 后缀；两个分支覆盖 IP 在标签前/后两种行格式）
+RE_CAND = re.compile(rb'''(?imx)
+    ^ [^\n]*? (?:
+        (?P<ip1>\d{1,3}(?:\.\d{1,3}){3}) (?:/\d{1,2})? [^\n]*? \#(?P<tag1>sg|hk|jp|tw|kr)\b
+      | \#(?P<tag2>sg|hk|jp|tw|kr)\b [^\n]*? (?P<ip2>\d{1,3}(?:\.\d{1,3}){3})
+    ) [^\n]*
+''')
 
 # 超时设置（秒）
 PING_TIMEOUT = 2.0
 TCP_TIMEOUT = 1.0
 
-# 并发线程数（可调）
-MAX_WORKERS = 8
+# 是否先做批量 ICMP 预筛。很多云主机丢弃 ICMP 却照常提供 443，
+# ping 白白多等一轮超时，默认关闭、直接 TCP 探测；需要时置 True 启用。
+USE_PING = False
 
+# 并发 TCP 探测上限（防止 fd 耗尽，可调）
+MAX_CONCURRENCY = 256
 
-def fetch_text() -> str:
-    """优先使用 requests，否则使用 urllib 回退。返回文本（str）。"""
-    try:
-        import requests
-        headers = {
-            "User-Agent": "Mozilla/5.0 (compatible; GithubAction/1.0)",
-            "Accept": "*/*",
-            "Connection": "close",
-        }
-        r = requests.get(URL, headers=headers, timeout=30)
-        r.raise_for_status()
-        if not r.encoding:
-            r.encoding = r.apparent_encoding or "utf-8"
-        return r.text
-    except Exception as e_requests:
+# 流式下载的分块大小（字节）
+FETCH_CHUNK = 65536
+
+# ICMP 批量探测的并发上限（icmplib 用）
+ICMP_CONCURRENCY = 256
+
+
+def fetch_chunks() -> Iterator[bytes]:
+    """
+    流式拉取源文本并按块产出原始字节，让下载与候选扫描重叠进行。
+    优先使用 requests（模块级 SESSION）流式读取；requests 不可用、
+    或在产出任何数据之前就失败时，回退到 urllib 一次性读取。
+    """
+    e_requests: Optional[Exception] = None
+    if SESSION is not None:
+        yielded = False
         try:
-            from urllib import request
-            req = request.Request(URL, headers={
-                "User-Agent": "Mozilla/5.0 (compatible; GithubAction/1.0)",
-                "Accept": "*/*",
-                "Connection": "close",
-            })
-            with request.urlopen(req, timeout=30) as resp:
-                data = resp.read()
-                content_type = None
-                try:
-                    content_type = resp.headers.get('Content-Type')
-                except Exception:
-                    pass
-        except Exception as e_urllib:
-            print("requests and urllib both failed:", e_requests, e_urllib)
-            raise
-
-        charset = None
-        if content_type:
-            m = re.search(r'charset=([^\s;]+)', content_type, flags=re.I)
-            if m:
-                charset = m.group(1).strip('"\'')
-
-        for enc in (charset, "utf-8", "latin1"):
-            if not enc:
+            with SESSION.get(URL, stream=True, timeout=30) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=FETCH_CHUNK):
+                    yielded = True
+                    yield chunk
+                return
+        except Exception as e:
+            if yielded:
+                # 已经产出部分数据，回退重拉会导致重复处理，直接上抛
+                raise
+            e_requests = e
+
+    yield _fetch_bytes_urllib(e_requests)
+
+
+def _fetch_bytes_urllib(e_requests: Optional[Exception] = None) -> bytes:
+    """urllib 回退：一次性读取整个响应体，返回原始字节。"""
+    try:
+        from urllib import request
+        req = request.Request(URL, headers=HEADERS)
+        with request.urlopen(req, timeout=30) as resp:
+            return resp.read()
+    except Exception as e_urllib:
+        print("requests and urllib both failed:", e_requests, e_urllib)
+        raise
+
+
+def valid_ipv4(ip: str) -> bool:
+    """用 inet_aton 一次性校验点分四段是否都在 0-255。"""
+    try:
+        socket.inet_aton(ip)
+    except OSError:
+        return False
+    return True
+
+
+def _icmp_checksum(data: bytes) -> int:
+    """标准 RFC 1071 校验和（ICMP 头部用）。"""
+    if len(data) % 2:
+        data += b"\x00"
+    s = sum(int.from_bytes(data[i:i + 2], "big") for i in range(0, len(data), 2))
+    s = (s >> 16) + (s & 0xFFFF)
+    s += s >> 16
+    return ~s & 0xFFFF
+
+
+def _icmp_probe_dgram(ips: List[str], timeout: float = PING_TIMEOUT) -> set:
+    """
+    用单个 SOCK_DGRAM+IPPROTO_ICMP socket（无需 root）向所有 IP 发送 Echo 请求，
+    然后在同一个 fd 上用 select 收集回包，按回包源地址判定可达。
+    系统不允许 ICMP datagram socket 时返回空集合，由 TCP 探测兜底。
+    """
+    alive: set = set()
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    except OSError:
+        return alive
+    try:
+        sock.setblocking(False)
+        pending = set()
+        for seq, ip in enumerate(ips):
+            header = struct.pack("!BBHHH", 8, 0, 0, 0, seq & 0xFFFF)
+            packet = struct.pack("!BBHHH", 8, 0, _icmp_checksum(header), 0, seq & 0xFFFF)
+            try:
+                sock.sendto(packet, (ip, 0))
+                pending.add(ip)
+            except OSError:
                 continue
+
+        deadline = time.monotonic() + timeout
+        while pending:
+            remain = deadline - time.monotonic()
+            if remain <= 0:
+                break
+            readable, _, _ = select.select([sock], [], [], remain)
+            if not readable:
+                break
             try:
-                return data.decode(enc)
-            except Exception:
-                pass
-        return data.decode("utf-8", errors="replace")
-
-
-def extract_ipv4(line: str) -> Optional[str]:
-    """从行中提取 IPv4（忽略可能的 /n 后缀），并简单校验每段在 0-255。"""
-    m = RE_IPV4.search(line)
-    if not m:
-        return None
-    ip = m.group(1)
-    parts = ip.split('.')
-    for p in parts:
+                data, addr = sock.recvfrom(1024)
+            except OSError:
+                continue
+            # Echo 回复 type == 0
+            if addr[0] in pending and data[:1] == b"\x00":
+                alive.add(addr[0])
+                pending.discard(addr[0])
+    finally:
+        sock.close()
+    return alive
+
+
+def icmp_probe(ips: List[str], timeout: float = PING_TIMEOUT) -> set:
+    """
+    批量 ICMP 探测，返回可达 IP 集合。
+    优先使用 icmplib（单事件循环批量收发），否则回退到单 socket 自行收发。
+    """
+    if not ips:
+        return set()
+    try:
+        import icmplib
+    except ImportError:
+        icmplib = None
+    if icmplib is not None:
         try:
-            if not (0 <= int(p) <= 255):
-                return None
+            hosts = icmplib.multiping(
+                list(ips), count=1, timeout=timeout,
+                concurrent_tasks=ICMP_CONCURRENCY, privileged=False,
+            )
+            return {h.address for h in hosts if h.is_alive}
         except Exception:
-            return None
-    return ip
+            pass
+    return _icmp_probe_dgram(list(ips), timeout=timeout)
 
 
-def ping_host(ip: str, timeout: float = PING_TIMEOUT) -> bool:
-    """使用系统 ping（-c 1 / -n 1），并用 subprocess.timeout 控制等待时间。"""
-    system = platform.system().lower()
+async def _tcp_probe_port(ip: str, port: int, timeout: float = TCP_TIMEOUT) -> bool:
+    """
+    异步连接单个端口，成功即返回 True。
+    探测 socket 设置 SO_LINGER(on, 0)：close 直接发 RST 而非四次挥手，
+    不留 TIME_WAIT，大批量探测时立即归还临时端口。
+    """
+    loop = asyncio.get_running_loop()
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        if system == "windows":
-            cmd = ["ping", "-n", "1", "-w", str(int(timeout *1000)), ip]
-        else:
-            cmd = ["ping", "-c", "1", ip]
-        res = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout + 0.5)
-        return res.returncode == 0
+        s.setblocking(False)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        await asyncio.wait_for(loop.sock_connect(s, (ip, port)), timeout)
+        return True
     except Exception:
         return False
+    finally:
+        s.close()
 
 
-def tcp_connect(ip: str, ports=(80, 443), timeout: float = TCP_TIMEOUT) -> bool:
-    """尝试连接端口列表，任一成功即认为可达。"""
-    for port in ports:
-        try:
-            with socket.create_connection((ip, port), timeout=timeout):
+async def tcp_probe(ip: str, ports=(80, 443), timeout: float = TCP_TIMEOUT) -> bool:
+    """同时向所有端口发起连接，任一先成功即认为可达，其余立即取消。"""
+    tasks = [asyncio.create_task(_tcp_probe_port(ip, port, timeout)) for port in ports]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            if await fut:
                 return True
-        except Exception:
-            continue
-    return False
-
-
-def is_reachable(ip: str) -> bool:
-    """先 ping，ping 失败则尝试 TCP 连接 80/443。"""
-    if ping_host(ip, timeout=PING_TIMEOUT):
-        return True
-    return tcp_connect(ip, ports=(80, 443), timeout=TCP_TIMEOUT)
+        return False
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
-def primary_tag_of_line(line: str) -> Optional[str]:
-    """按 COUNTRIES 顺序返回该行的主标签（若包含多个标签，以顺序优先）。"""
-    low = line.lower()
-    for c in COUNTRIES:
-        if f"#{c}" in low:
-            return c
-    return None
+async def _run_tests(candidates: Iterable[Tuple[int, str, str, str]],
+                     saved: List[List[Tuple[int, str]]]) -> int:
+    """
+    流式消费候选项：每凑满 ICMP_CONCURRENCY 个为一批，启用 USE_PING 时
+    先做批量 ICMP 预筛，ping 不通（或未启用时全部）转入并发 TCP 探测，
+    同时继续拉取下一批。
+    所有国家满额后停止拉取并取消在途任务，结果直接写入 saved，
+    返回实际检测数量。
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    pending: set = set()
+    tested = 0
+    done = False
+
+    # 剩余总名额计数：保存一条减一，归零即全部满额
+    remaining = sum(CAPS)
+
+    def record(cand, ok):
+        nonlocal tested, done, remaining
+        if done:
+            return
+        idx, line, tag, ip = cand
+        tested += 1
+        if ok:
+            i = TAG_IDX[tag]
+            bucket = saved[i]
+            if len(bucket) < CAPS[i]:
+                bucket.append((idx, line))
+                remaining -= 1
+        # 名额用尽即所有国家满额，取消在途任务并停止拉取
+        if remaining == 0:
+            done = True
+            for task in list(pending):
+                task.cancel()
+
+    async def probe(cand):
+        try:
+            try:
+                ok = await tcp_probe(cand[3])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                ok = False
+            record(cand, ok)
+        finally:
+            sem.release()
+
+    async def flush(window):
+        alive = ()
+        if USE_PING:
+            # 批量 ICMP 放到线程里跑，不阻塞事件循环里的 TCP 探测
+            alive = await asyncio.to_thread(icmp_probe, [ip for _, _, _, ip in window])
+        for cand in window:
+            if done:
+                return
+            if cand[3] in alive:
+                record(cand, True)
+                continue
+            await sem.acquire()
+            if done:
+                sem.release()
+                return
+            task = asyncio.create_task(probe(cand))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+    window: List[Tuple[int, str, str, str]] = []
+    for cand in candidates:
+        window.append(cand)
+        if len(window) >= ICMP_CONCURRENCY:
+            await flush(window)
+            window = []
+            if done:
+                break
+    if window and not done:
+        await flush(window)
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    return tested
 
 
-def collect_candidates(text: str) -> List[Tuple[int, str, str, str]]:
+def iter_candidates(chunks: Iterable[bytes]) -> Iterator[Tuple[int, str, str, str]]:
     """
-    扫描文本并收集候选项（按原始顺序），返回列表 (index, line, tag, ip)。
-    去重基于完整行字符串（保留首次出现）。
+    流式扫描字节块并逐个产出候选项 (index, line, tag, ip)，按原始顺序。
+    每个完整块只跑一次 C 级 finditer，整行/标签/IP 全部来自命名组，
+    保留下来的候选才解码整行；index 为命中序号，仅用于恢复原始顺序。
+    去重基于 (tag, ip)（保留首次出现）——比存整行省内存，
+    且能合并只差注释/空白的重复 IP。
+    生成器形式让检测端边下载边扫描边探测，满额后可以直接停止。
     """
-    seen = set()
-    candidates: List[Tuple[int, str, str, str]] = []
-    for idx, raw in enumerate(text.splitlines()):
-        line = raw.strip()
-        if not line:
-            continue
-        if not PAT_TAG.search(line):
-            continue
-        if line in seen:
-            continue
-        seen.add(line)
-        tag = primary_tag_of_line(line)
-        if not tag:
+    # 去重用 dict（插入有序），setdefault 一次哈希完成查重+登记
+    seen: Dict[Tuple[str, str], int] = {}
+    idx = 0
+    # 热循环的本地绑定：省去每次迭代的全局/属性查找
+    finditer = RE_CAND.finditer
+    valid = valid_ipv4
+    seen_setdefault = seen.setdefault
+
+    def scan(block: bytes) -> Iterator[Tuple[int, str, str, str]]:
+        nonlocal idx
+        for m in finditer(block):
+            ip = (m.group("ip1") or m.group("ip2")).decode("ascii")
+            if not valid(ip):
+                continue
+            tag = (m.group("tag1") or m.group("tag2")).lower().decode("ascii")
+            if seen_setdefault((tag, ip), idx) != idx:
+                continue
+            line = m.group(0).decode("utf-8", errors="replace").strip()
+            yield (idx, line, tag, ip)
+            idx += 1
+
+    buf = b""
+    for chunk in chunks:
+        if not chunk:
             continue
-        ip = extract_ipv4(line)
-        if not ip:
+        buf += chunk
+        # 只扫到最后一个完整行，行尾残块并入下一块
+        cut = buf.rfind(b"\n")
+        if cut < 0:
             continue
-        candidates.append((idx, line, tag, ip))
-    return candidates
+        block, buf = buf[:cut], buf[cut + 1:]
+        yield from scan(block)
+    if buf:
+        yield from scan(buf)
 
 
-def run_concurrent_tests(candidates: List[Tuple[int, str, str, str]]) -> Tuple[Dict[str, List[Tuple[int, str]]], int]:
+def run_concurrent_tests(candidates: Iterable[Tuple[int, str, str, str]]) -> Tuple[List[List[Tuple[int, str]]], int]:
     """
-    并发检测候选 reachability。
-    返回 saved (country -> list[(index,line)]) 与 tested 数量。
+    流式并发检测候选 reachability（可选批量 ICMP，失败转 TCP 80/443）。
+    candidates 可以是生成器：边扫描边探测，满额后停止消费。
+    返回 saved（按 COUNTRIES 顺序的 list[(index,line)] 列表）与 tested 数量。
     """
-    saved: Dict[str, List[Tuple[int, str]]] = {c: [] for c in COUNTRIES}
-    tested = 0
-    if not candidates:
-        return saved, 0
-
-    futures = {}
-    workers = min(MAX_WORKERS, max(1, len(candidates)))
-    with ThreadPoolExecutor(max_workers=workers) as ex:
-        for cand in candidates:
-            idx, line, tag, ip = cand
-            fut = ex.submit(is_reachable, ip)
-            futures[fut] = cand
-
-        for fut in as_completed(list(futures.keys())):
-            cand = futures.get(fut)
-            if cand is None:
-                continue
-            idx, line, tag, ip = cand
-            tested += 1
-            try:
-                ok = fut.result()
-            except Exception:
-                ok = False
-            if ok and len(saved[tag]) < MAX_PER_COUNTRY.get(tag, 0):
-                saved[tag].append((idx, line))
-            # 若所有国家都已满额，取消剩余任务并退出
-            if all(len(saved[c]) >= MAX_PER_COUNTRY.get(c, 0) for c in COUNTRIES):
-                for other_fut in list(futures.keys()):
-                    if not other_fut.done():
-                        try:
-                            other_fut.cancel()
-                        except Exception:
-                            pass
-                break
+    saved: List[List[Tuple[int, str]]] = [[] for _ in COUNTRIES]
+    tested = asyncio.run(_run_tests(candidates, saved))
 
     # 按原始索引排序每个国家以恢复原始顺序
-    for c in COUNTRIES:
-        saved[c].sort(key=lambda t: t[0])
+    for bucket in saved:
+        bucket.sort(key=lambda t: t[0])
     return saved, tested
 
 
-def write_output(saved: Dict[str, List[Tuple[int, str]]], out_path: Path = OUT_FILE) -> None:
+def write_output(saved: List[List[Tuple[int, str]]], out_path: Path = OUT_FILE) -> None:
     """
-    把保存的行按国家顺序写入文件。
+    把保存的行按国家顺序写入文件（saved 已按 COUNTRIES 顺序排列）。
     注意：按你的要求脚本不会自动创建目录；若目录不存在则报错并退出。
     """
     if not out_path.parent.exists():
         print(f"输出目录 {out_path.parent} 不存在。脚本不会自动创建，请先在仓库中创建该目录并提交（或确保 workflow 创建）。")
         sys.exit(2)
 
-    lines: List[str] = []
-    for c in COUNTRIES:
-        lines.extend([ln for (_, ln) in saved.get(c, [])])
+    out = "\n".join(ln for bucket in saved for (_, ln) in bucket)
 
     try:
-        with out_path.open("w",encoding="utf-8", newline="\n") as f:
-            for ln in lines:
-                f.write(ln + "\n")
+        with out_path.open("w", encoding="utf-8", newline="\n") as f:
+            if out:
+                f.write(out)
+                f.write("\n")
     except Exception as e:
         print(f"写入文件 {out_path} 失败: {e}")
         raise
@@ -239,26 +395,24 @@ def write_output(saved: Dict[str, List[Tuple[int, str]]], out_path: Path = OUT_F
 
 def main():
     try:
-        text = fetch_text()
+        saved, tested = run_concurrent_tests(iter_candidates(fetch_chunks()))
     except Exception as e:
         print("Fetch failed:", e)
         sys.exit(1)
 
-    candidates = collect_candidates(text)
-    if not candidates:
+    if tested == 0:
         print("No candidates found for tags.")
         sys.exit(0)
 
-    saved, tested = run_concurrent_tests(candidates)
-    total_saved = sum(len(v) for v in saved.values())
+    total_saved = sum(len(v) for v in saved)
 
     if total_saved == 0:
         print(f"No reachable lines found (tested {tested} candidates).")
     else:
         write_output(saved, OUT_FILE)
         print(f"Saved {total_saved} lines to {OUT_FILE} (tested {tested} candidates).")
-        for c in COUNTRIES:
-            print(f"  {c.upper()}: saved {len(saved.get(c, []))}/{MAX_PER_COUNTRY.get(c)}")
+        for i, c in enumerate(COUNTRIES):
+            print(f"  {c.upper()}: saved {len(saved[i])}/{CAPS[i]}")
 
     sys.exit(0)
 